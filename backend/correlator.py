@@ -6,11 +6,17 @@ Correlation criteria:
 - Time window proximity (±1 hour by default)
 - Category relationships
 """
-import json
+import orjson
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+from dataclasses import dataclass, field
 from datetime import datetime, timedelta
-from typing import List, Dict, Set, Optional
+from itertools import zip_longest
+from typing import List, Dict, Set, Optional, Tuple
+from sqlalchemy import nulls_first, or_, select, true, union
 from sqlalchemy.orm import Session
-from models import Alert, Incident, IncidentStatus
+from database import batched
+from models import Alert, Incident, IncidentStatus, Severity, SEVERITY_RANKS, incident_alerts, normalize_entity
 
 
 # Time window for correlating alerts (in hours)
@@ -19,27 +25,102 @@ CORRELATION_TIME_WINDOW_HOURS = 1
 # Minimum entity overlap score to correlate alerts
 MIN_OVERLAP_SCORE = 1
 
+# Overlap score per matching entity type (user match is weighted higher)
+ENTITY_WEIGHTS = {"users": 2, "ips": 1, "devices": 1}
 
-def calculate_entity_overlap(alert1: Alert, alert2: Alert) -> int:
-    """
-    Calculate entity overlap score between two alerts.
-    Returns number of matching entities.
-    """
-    score = 0
+# Incident JSON columns holding the aggregated entity sets
+ENTITY_COLUMNS = {
+    "users": "related_users",
+    "ips": "related_ips",
+    "devices": "related_devices",
+    "locations": "related_locations",
+}
+
+# Reference point for converting naive UTC timestamps to epoch seconds
+EPOCH = datetime(1970, 1, 1)
+
+
+@dataclass(slots=True)
+class AlertMini:
+    """Lightweight row with just the alert fields correlation reads."""
+    id: int
+    entity_user: Optional[str]
+    entity_ip: Optional[str]
+    entity_device: Optional[str]
+    timestamp: Optional[datetime]
+    # Normalized (lowercased) entity keys, computed once at load
+    keys: List[Tuple[str, str]] = field(init=False)
+    
+    def __post_init__(self):
+        self.keys = entity_keys(self)
+    
+    @classmethod
+    def from_alert(cls, alert: Alert) -> "AlertMini":
+        return cls(alert.id, alert.entity_user, alert.entity_ip, alert.entity_device, alert.timestamp)
+
+
+# Columns selected into AlertMini (same order as its fields)
+CORRELATION_COLUMNS = (Alert.id, Alert.entity_user, Alert.entity_ip, Alert.entity_device, Alert.timestamp)
+
+
+class UnionFind:
+    """Disjoint-set over hashable nodes with path compression and union by rank."""
     
-    if alert1.entity_user and alert2.entity_user:
-        if alert1.entity_user.lower() == alert2.entity_user.lower():
-            score += 2  # User match is weighted higher
+    def __init__(self):
+        self.parent: Dict[object, object] = {}
+        self.rank: Dict[object, int] = {}
     
-    if alert1.entity_ip and alert2.entity_ip:
-        if alert1.entity_ip == alert2.entity_ip:
-            score += 1
+    def add(self, node: object) -> None:
+        if node not in self.parent:
+            self.parent[node] = node
+            self.rank[node] = 0
     
-    if alert1.entity_device and alert2.entity_device:
-        if alert1.entity_device.lower() == alert2.entity_device.lower():
-            score += 1
+    def find(self, node: object) -> object:
+        self.add(node)
+        root = node
+        while self.parent[root] != root:
+            root = self.parent[root]
+        # Path compression
+        while self.parent[node] != root:
+            self.parent[node], node = root, self.parent[node]
+        return root
     
-    return score
+    def union(self, a: object, b: object) -> object:
+        root_a, root_b = self.find(a), self.find(b)
+        if root_a == root_b:
+            return root_a
+        if self.rank[root_a] < self.rank[root_b]:
+            root_a, root_b = root_b, root_a
+        self.parent[root_b] = root_a
+        if self.rank[root_a] == self.rank[root_b]:
+            self.rank[root_a] += 1
+        return root_a
+
+
+def entity_keys(alert: Alert) -> List[Tuple[str, str]]:
+    """
+    Return the (entity type, normalized value) pairs used to match alerts.
+    Users and devices compare case-insensitively (normalize_entity, as
+    stored in Alert.entity_*_key), IPs exactly. Two alerts
+    share an entity bucket exactly when they have an overlap score >= 1.
+    """
+    keys = []
+    if alert.entity_user:
+        keys.append(("users", normalize_entity(alert.entity_user)))
+    if alert.entity_ip:
+        keys.append(("ips", alert.entity_ip))
+    if alert.entity_device:
+        keys.append(("devices", normalize_entity(alert.entity_device)))
+    return keys
+
+
+def calculate_entity_overlap(alert1: Alert, alert2: Alert) -> int:
+    """
+    Calculate entity overlap score between two alerts.
+    Returns the weighted number of matching entities.
+    """
+    shared = set(entity_keys(alert1)).intersection(entity_keys(alert2))
+    return sum(ENTITY_WEIGHTS[entity_type] for entity_type, _ in shared)
 
 
 def is_within_time_window(alert1: Alert, alert2: Alert, hours: int = CORRELATION_TIME_WINDOW_HOURS) -> bool:
@@ -57,6 +138,10 @@ def find_related_alerts(
     time_window_hours: int = CORRELATION_TIME_WINDOW_HOURS
 ) -> List[Alert]:
     """Find all alerts that correlate with the given alert."""
+    # Without any entity nothing can overlap
+    if not (new_alert.entity_user or new_alert.entity_ip or new_alert.entity_device):
+        return []
+    
     related = []
     
     for existing in existing_alerts:
@@ -75,6 +160,142 @@ def find_related_alerts(
     return related
 
 
+class EntityBucket:
+    """Positions of alerts sharing one entity value, ordered by timestamp."""
+    
+    __slots__ = ("times", "positions", "undated")
+    
+    def __init__(self):
+        self.times: List[float] = []
+        self.positions: List[int] = []
+        self.undated: List[int] = []
+    
+    def add(self, position: int, ts: Optional[float]) -> None:
+        if ts is None:
+            self.undated.append(position)
+        else:
+            self.times.append(ts)
+            self.positions.append(position)
+    
+    def sort(self) -> None:
+        order = sorted(range(len(self.times)), key=self.times.__getitem__)
+        self.times = [self.times[i] for i in order]
+        self.positions = [self.positions[i] for i in order]
+    
+    def in_window(self, ts: Optional[float], window: float) -> List[int]:
+        """Positions within `window` seconds of `ts`, found by binary search."""
+        # If no timestamp, assume within window
+        if ts is None:
+            return self.positions + self.undated
+        lo = bisect_left(self.times, ts - window)
+        hi = bisect_right(self.times, ts + window)
+        return self.positions[lo:hi] + self.undated
+
+
+def build_entity_index(
+    keys: List[List[Tuple[str, str]]],
+    timestamps: List[Optional[float]]
+) -> Dict[str, Dict[str, EntityBucket]]:
+    """
+    Map each normalized entity value to a time-ordered bucket of alert
+    positions. keys[i] holds entity_keys() of the alert at position i.
+    """
+    index = {
+        "users": defaultdict(EntityBucket),
+        "ips": defaultdict(EntityBucket),
+        "devices": defaultdict(EntityBucket),
+    }
+    
+    for position, alert_keys in enumerate(keys):
+        for entity_type, value in alert_keys:
+            index[entity_type][value].add(position, timestamps[position])
+    
+    for buckets in index.values():
+        for bucket in buckets.values():
+            bucket.sort()
+    
+    return index
+
+
+def to_epoch_seconds(timestamp: Optional[datetime]) -> Optional[float]:
+    """Convert a naive UTC timestamp to epoch seconds."""
+    if timestamp is None:
+        return None
+    return (timestamp - EPOCH).total_seconds()
+
+
+def find_candidate_positions(
+    position: int,
+    keys: List[List[Tuple[str, str]]],
+    index: Dict[str, Dict[str, EntityBucket]],
+    timestamps: List[Optional[float]],
+    time_window_hours: int = CORRELATION_TIME_WINDOW_HOURS
+) -> List[int]:
+    """
+    Find positions of alerts sharing an entity bucket with the alert at
+    `position` and falling inside the time window. Only the in-window slice of each
+    bucket is visited, instead of every alert in the database.
+    """
+    window = time_window_hours * 3600
+    ts = timestamps[position]
+    
+    candidates: Set[int] = set()
+    for entity_type, value in keys[position]:
+        candidates.update(index[entity_type][value].in_window(ts, window))
+    candidates.discard(position)
+    
+    return sorted(candidates)
+
+
+def load_candidate_alerts(
+    db: Session,
+    new_alerts: List[AlertMini],
+    time_window_hours: int = CORRELATION_TIME_WINDOW_HOURS
+) -> List[AlertMini]:
+    """
+    Load stored alerts that may correlate with new_alerts: those sharing a
+    user, IP or device within the time range the new alerts span (±window).
+    The three lookups are UNION-ed in the database and served by the
+    composite entity/timestamp indexes; rows come back as AlertMini.
+    """
+    # Alerts without entities cannot match anything, so they don't widen the lookup
+    new_alerts = [alert for alert in new_alerts if alert.keys]
+    if not new_alerts:
+        return []
+    
+    values: Dict[str, Set[str]] = {"users": set(), "ips": set(), "devices": set()}
+    for alert in new_alerts:
+        for entity_type, value in alert.keys:
+            values[entity_type].add(value)
+    
+    timestamps = [alert.timestamp for alert in new_alerts if alert.timestamp]
+    if len(timestamps) == len(new_alerts):
+        window = timedelta(hours=time_window_hours)
+        in_window = or_(
+            Alert.timestamp.between(min(timestamps) - window, max(timestamps) + window),
+            Alert.timestamp.is_(None),
+        )
+    else:
+        # If no timestamp, assume within window
+        in_window = true()
+    
+    lookups = [
+        (Alert.entity_user_key, sorted(values["users"])),
+        (Alert.entity_ip, sorted(values["ips"])),
+        (Alert.entity_device_key, sorted(values["devices"])),
+    ]
+    candidates: Dict[int, AlertMini] = {}
+    for batches in zip_longest(*(batched(values) for _, values in lookups)):
+        selects = [
+            select(*CORRELATION_COLUMNS).where(column.in_(batch), in_window)
+            for (column, _), batch in zip(lookups, batches)
+            if batch
+        ]
+        for row in db.execute(union(*selects)):
+            candidates[row.id] = AlertMini(*row)
+    return list(candidates.values())
+
+
 def collect_entities(alerts: List[Alert]) -> Dict[str, Set[str]]:
     """Collect all unique entities from a list of alerts."""
     entities = {
@@ -97,25 +318,43 @@ def collect_entities(alerts: List[Alert]) -> Dict[str, Set[str]]:
     return entities
 
 
-def generate_incident_title(alerts: List[Alert]) -> str:
-    """Generate a descriptive title for an incident based on its alerts."""
+def load_incident_entities(incident: Incident) -> Optional[Dict[str, Set[str]]]:
+    """Read the entity sets stored on an incident (None if never stored)."""
+    if incident.related_users is None:
+        return None
+    return {
+        entity_type: set(incident.parsed_json(column, []))
+        for entity_type, column in ENTITY_COLUMNS.items()
+    }
+
+
+def highest_severity_of(*severities: Optional[Severity]) -> Optional[Severity]:
+    """Return the highest of the given severities, ignoring None."""
+    present = [s for s in severities if s]
+    if not present:
+        return None
+    return max(present, key=lambda s: SEVERITY_RANKS.get(s, 0))
+
+
+def highest_severity(alerts: List[Alert]) -> Optional[Severity]:
+    """Return the highest severity among the given alerts."""
     if not alerts:
+        return None
+    return max(alerts, key=lambda a: a.severity_rank or 0).severity
+
+
+def build_incident_title(categories: Set[str], max_severity: Optional[Severity], alert_count: int) -> str:
+    """Build an incident title from its categories, highest severity and size."""
+    if not alert_count:
         return "Unknown Incident"
     
-    # Get unique categories
-    categories = list(set(a.category for a in alerts if a.category))
-    
-    # Get highest severity
-    severity_order = {"critical": 4, "high": 3, "medium": 2, "low": 1}
-    max_severity = max(alerts, key=lambda a: severity_order.get(a.severity.value, 0))
-    
-    # Build title
+    severity_label = max_severity.value.title() if max_severity else "Unknown"
     if len(categories) == 1:
-        return f"{max_severity.severity.value.title()} {categories[0]} Incident"
+        return f"{severity_label} {next(iter(categories))} Incident"
     elif len(categories) > 1:
-        return f"{max_severity.severity.value.title()} Multi-Category Incident ({len(alerts)} alerts)"
+        return f"{severity_label} Multi-Category Incident ({alert_count} alerts)"
     else:
-        return f"{max_severity.severity.value.title()} Security Incident"
+        return f"{severity_label} Security Incident"
 
 
 def create_or_update_incident(
@@ -124,36 +363,56 @@ def create_or_update_incident(
     existing_incident: Optional[Incident] = None
 ) -> Incident:
     """Create a new incident or update existing one with the given alerts."""
-    from triage import calculate_triage_score  # Import here to avoid circular import
+    from triage import IncidentEntities, calculate_triage_score  # Import here to avoid circular import
     
     entities = collect_entities(alerts)
+    categories = set(a.category for a in alerts if a.category)
+    max_severity = highest_severity(alerts)
     
     if existing_incident:
         incident = existing_incident
         # Merge alerts
+        seen = {a.id for a in incident.alerts}
         for alert in alerts:
-            if alert not in incident.alerts:
+            if alert.id not in seen:
                 incident.alerts.append(alert)
+                seen.add(alert.id)
         alerts = incident.alerts  # Recalculate with all alerts
-        entities = collect_entities(alerts)
-        incident.title = generate_incident_title(alerts)
+        
+        # Extend the stored entity/category sets with the merged alerts only;
+        # incidents stored before these were persisted are rescanned once
+        stored_entities = load_incident_entities(incident)
+        if stored_entities is None:
+            entities = collect_entities(alerts)
+        else:
+            for entity_type, values in stored_entities.items():
+                values.update(entities[entity_type])
+            entities = stored_entities
+        
+        if incident.related_categories is None or incident.max_severity is None:
+            categories = set(a.category for a in alerts if a.category)
+            max_severity = highest_severity(alerts)
+        else:
+            categories.update(incident.related_categories_list)
+            max_severity = highest_severity_of(incident.max_severity, max_severity)
     else:
-        incident = Incident(
-            title=generate_incident_title(alerts),
-            status=IncidentStatus.NEW,
-        )
+        incident = Incident(status=IncidentStatus.NEW)
         incident.alerts = alerts
     
+    incident.title = build_incident_title(categories, max_severity, len(alerts))
+    incident.related_categories = orjson.dumps(sorted(categories)).decode()
+    incident.max_severity = max_severity
+    
     # Store entity lists as JSON
-    incident.related_users = json.dumps(list(entities["users"]))
-    incident.related_ips = json.dumps(list(entities["ips"]))
-    incident.related_devices = json.dumps(list(entities["devices"]))
-    incident.related_locations = json.dumps(list(entities["locations"]))
+    incident.related_users = orjson.dumps(list(entities["users"])).decode()
+    incident.related_ips = orjson.dumps(list(entities["ips"])).decode()
+    incident.related_devices = orjson.dumps(list(entities["devices"])).decode()
+    incident.related_locations = orjson.dumps(list(entities["locations"])).decode()
     
     # Calculate triage score
-    score, explanation = calculate_triage_score(alerts, entities, db)
+    score, explanation = calculate_triage_score(alerts, IncidentEntities.from_sets(entities), db)
     incident.priority_score = score
-    incident.score_explanation = json.dumps(explanation)
+    incident.score_explanation = orjson.dumps(explanation).decode()
     
     if not existing_incident:
         db.add(incident)
@@ -165,61 +424,161 @@ def correlate_alerts(db: Session, new_alerts: List[Alert]) -> List[Incident]:
     """
     Main correlation function. Takes new alerts and:
     1. Finds related existing alerts/incidents
-    2. Groups new alerts with each other
-    3. Creates or updates incidents
+    2. Groups new alerts with each other (connected components)
+    3. Creates or updates one incident per group
     
     Returns list of created/updated incidents.
     """
     if not new_alerts:
         return []
     
-    # Get all existing alerts for correlation
-    existing_alerts = db.query(Alert).all()
+    # Get existing alerts that can correlate. New alerts are normally
+    # already persisted, so merge by id to avoid comparing them twice.
+    new_minis = [AlertMini.from_alert(alert) for alert in new_alerts]
+    pool = {alert.id: alert for alert in load_candidate_alerts(db, new_minis)}
+    for alert in new_minis:
+        pool.setdefault(alert.id, alert)
+    all_alerts = list(pool.values())
+    positions = {alert.id: position for position, alert in enumerate(all_alerts)}
+    new_alert_ids = {alert.id for alert in new_alerts}
     
-    # Track which alerts have been assigned to incidents
-    assigned_alerts: Set[int] = set()
-    incidents: List[Incident] = []
+    # Bucket alerts by their (already normalized) entity keys, so each alert
+    # is only compared against alerts that share a user, IP or device with
+    # it and fall in the window
+    keys = [alert.keys for alert in all_alerts]
+    timestamps = [to_epoch_seconds(alert.timestamp) for alert in all_alerts]
+    index = build_entity_index(keys, timestamps)
     
+    # Union each new alert with every alert it correlates with
+    uf = UnionFind()
     for new_alert in new_alerts:
-        if new_alert.id in assigned_alerts:
+        uf.add(new_alert.id)
+        # Alerts without entities stay singletons
+        if not keys[positions[new_alert.id]]:
             continue
-        
-        # Find related alerts (both new and existing)
-        all_alerts = existing_alerts + new_alerts
-        related = find_related_alerts(new_alert, all_alerts)
-        
-        # Check if any related alerts are already in an incident
-        existing_incident = None
-        for related_alert in related:
-            if related_alert.incidents:
-                existing_incident = related_alert.incidents[0]
-                break
-        
-        # Collect alert group
-        alert_group = [new_alert] + [a for a in related if a in new_alerts and a.id not in assigned_alerts]
-        
-        # Create or update incident
-        incident = create_or_update_incident(db, alert_group, existing_incident)
-        incidents.append(incident)
-        
-        # Mark alerts as assigned
-        for alert in alert_group:
-            assigned_alerts.add(alert.id)
+        for position in find_candidate_positions(
+            positions[new_alert.id], keys, index, timestamps
+        ):
+            uf.union(new_alert.id, all_alerts[position].id)
+    
+    # Tie related existing alerts to their incidents through one synthetic
+    # node per incident, resolved with a single association-table query
+    related_existing = [alert_id for alert_id in uf.parent if alert_id not in new_alert_ids]
+    memberships = []
+    for batch in batched(related_existing):
+        memberships.extend(db.query(
+            incident_alerts.c.alert_id, incident_alerts.c.incident_id
+        ).filter(incident_alerts.c.alert_id.in_(batch)))
+    for alert_id, incident_id in memberships:
+        uf.union(alert_id, ("incident", incident_id))
+    
+    # If a group touches several incidents, extend the oldest one
+    incident_for_root: Dict[object, int] = {}
+    for alert_id, incident_id in memberships:
+        root = uf.find(alert_id)
+        incident_for_root[root] = min(incident_id, incident_for_root.get(root, incident_id))
+    existing_incidents = {}
+    if incident_for_root:
+        existing_incidents = {
+            incident.id: incident
+            for incident in db.query(Incident).filter(
+                Incident.id.in_(set(incident_for_root.values()))
+            )
+        }
+    
+    # One incident per connected group of new alerts
+    groups: Dict[object, List[Alert]] = defaultdict(list)
+    for new_alert in new_alerts:
+        groups[uf.find(new_alert.id)].append(new_alert)
+    
+    incidents: List[Incident] = []
+    for root, alert_group in groups.items():
+        existing_incident = existing_incidents.get(incident_for_root.get(root))
+        incidents.append(create_or_update_incident(db, alert_group, existing_incident))
     
     return incidents
 
 
-def recorrelate_all(db: Session) -> List[Incident]:
+def recorrelate_all(db: Session, time_window_hours: int = CORRELATION_TIME_WINDOW_HOURS) -> List[Incident]:
     """
     Re-run correlation on all alerts.
     Useful after importing new data or adjusting correlation parameters.
+    
+    Alerts are swept once in time order. Per entity value only the latest
+    alert is kept: every alert still inside the window has already been
+    unioned with it, so one union per entity is enough. Incidents whose
+    alert set is unchanged are kept (preserving analyst status and notes);
+    only stale incidents are removed.
     """
-    # Clear existing incident associations
-    db.query(Incident).delete()
-    db.commit()
+    window = time_window_hours * 3600
+    uf = UnionFind()
+    latest: Dict[Tuple[str, str], Tuple[float, int]] = {}
+    undated_anchor: Dict[Tuple[str, str], int] = {}
+    alert_ids: List[int] = []
+    
+    # Undated alerts first: they correlate with every alert sharing an entity
+    rows = db.execute(
+        select(*CORRELATION_COLUMNS)
+        .order_by(nulls_first(Alert.timestamp.asc()), Alert.id)
+        .execution_options(yield_per=1000)
+    )
+    for row in rows:
+        alert = AlertMini(*row)
+        alert_ids.append(alert.id)
+        uf.add(alert.id)
+        ts = to_epoch_seconds(alert.timestamp)
+        for key in alert.keys:
+            if key in undated_anchor:
+                uf.union(alert.id, undated_anchor[key])
+            if ts is None:
+                undated_anchor.setdefault(key, alert.id)
+                continue
+            previous = latest.get(key)
+            if previous and ts - previous[0] <= window:
+                uf.union(alert.id, previous[1])
+            latest[key] = (ts, alert.id)
+    
+    groups: Dict[object, List[int]] = defaultdict(list)
+    for alert_id in alert_ids:
+        groups[uf.find(alert_id)].append(alert_id)
+    
+    # Match groups against current incident membership
+    members: Dict[int, Set[int]] = defaultdict(set)
+    for alert_id, incident_id in db.query(incident_alerts.c.alert_id, incident_alerts.c.incident_id):
+        members[incident_id].add(alert_id)
+    incident_of: Dict[int, int] = {}
+    for incident_id, member_ids in members.items():
+        for alert_id in member_ids:
+            incident_of.setdefault(alert_id, incident_id)
+    
+    kept: Dict[object, int] = {}
+    for root, group_ids in groups.items():
+        incident_id = incident_of.get(group_ids[0])
+        if incident_id is not None and members[incident_id] == set(group_ids):
+            kept[root] = incident_id
     
-    # Get all alerts
-    all_alerts = db.query(Alert).order_by(Alert.timestamp).all()
+    # Remove stale incidents and their alert links in bulk
+    kept_ids = set(kept.values())
+    stale_ids = [incident_id for (incident_id,) in db.query(Incident.id) if incident_id not in kept_ids]
+    for batch in batched(stale_ids):
+        db.execute(incident_alerts.delete().where(incident_alerts.c.incident_id.in_(batch)))
+        db.query(Incident).filter(Incident.id.in_(batch)).delete(synchronize_session=False)
+    db.expire_all()
     
-    # Re-correlate
-    return correlate_alerts(db, all_alerts)
+    kept_incidents: Dict[int, Incident] = {}
+    for batch in batched(sorted(kept_ids)):
+        kept_incidents.update(
+            (incident.id, incident)
+            for incident in db.query(Incident).filter(Incident.id.in_(batch))
+        )
+    
+    # Every alert lands in an incident, so load full rows once for all of them
+    alerts_by_id = {alert.id: alert for alert in db.query(Alert)}
+    
+    incidents: List[Incident] = []
+    for root, group_ids in groups.items():
+        alert_group = [alerts_by_id[alert_id] for alert_id in group_ids]
+        existing_incident = kept_incidents.get(kept.get(root))
+        incidents.append(create_or_update_incident(db, alert_group, existing_incident))
+    
+    return incidents
@@ -1,7 +1,11 @@
 """Database configuration and session management."""
-from sqlalchemy import create_engine
+from itertools import islice
+from typing import Iterable, Iterator
+
+from sqlalchemy import create_engine, inspect, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.schema import CreateIndex
 
 SQLALCHEMY_DATABASE_URL = "sqlite:///./security_triage.db"
 
@@ -11,6 +15,9 @@ engine = create_engine(
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
+# Maximum number of values bound into a single IN (...) clause
+IN_CLAUSE_BATCH_SIZE = 500
+
 
 def get_db():
     """Dependency that provides a database session."""
@@ -19,3 +26,37 @@ def get_db():
         yield db
     finally:
         db.close()
+
+
+def batched(items: Iterable, size: int = IN_CLAUSE_BATCH_SIZE) -> Iterator[list]:
+    """Yield successive lists of at most `size` items (for IN clauses)."""
+    iterator = iter(items)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def add_missing_schema(bind) -> None:
+    """
+    Add model columns and indexes missing from existing tables.
+    
+    create_all() only creates missing tables, so databases created by an
+    older version would otherwise lack newer columns. Idempotent; added
+    columns start out NULL.
+    """
+    inspector = inspect(bind)
+    preparer = bind.dialect.identifier_preparer
+    with bind.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                connection.execute(text(
+                    f"ALTER TABLE {preparer.format_table(table)} "
+                    f"ADD COLUMN {preparer.format_column(column)} {column.type.compile(dialect=bind.dialect)}"
+                ))
+            # Reflection skips expression indexes, so let the database check
+            for index in table.indexes:
+                connection.execute(CreateIndex(index, if_not_exists=True))
@@ -7,31 +7,54 @@ Main application with REST API for:
 - Analyst workflow management
 - Report generation
 """
-import json
+import io
+import orjson
 import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 from datetime import datetime
-from typing import List, Optional
+from typing import List, Optional, Tuple
 from fastapi import FastAPI, Depends, HTTPException, UploadFile, File, Query, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import PlainTextResponse
-from sqlalchemy.orm import Session
+from fastapi.responses import ORJSONResponse, PlainTextResponse
+from sqlalchemy import case, func, insert
+from sqlalchemy.orm import Session, selectinload
 
-from database import engine, get_db, Base
-from models import Alert, Incident, AuditLog, IncidentStatus, Severity
+from database import engine, get_db, Base, add_missing_schema, batched
+from models import Alert, Incident, AuditLog, IncidentStatus, Severity, backfill_entity_keys, backfill_severity_rank, incident_alerts
 from schemas import (
     AlertResponse, IncidentResponse, IncidentListResponse, IncidentUpdate,
     DashboardStats, UploadResponse, AuditLogResponse
 )
-from normalizer import parse_file_content
+from normalizer import NormalizedAlert, parse_file, shutdown_normalize_pool
 from correlator import correlate_alerts, recorrelate_all
 
-# Create database tables
-Base.metadata.create_all(bind=engine)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Prepare the database on startup and stop the normalizer pool on shutdown.
+    
+    Schema setup runs here rather than at import: process-pool workers
+    re-import the main module and must not touch the database.
+    """
+    # Create database tables, and bring databases from older versions up to date
+    Base.metadata.create_all(bind=engine)
+    add_missing_schema(engine)
+    backfill_severity_rank(engine)
+    backfill_entity_keys(engine)
+    yield
+    shutdown_normalize_pool()
+
 
 app = FastAPI(
     title="Security Incident Triage Dashboard",
     description="API for M365 security alert ingestion, correlation, and triage",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan
 )
 
 # CORS configuration for frontend
@@ -53,33 +76,45 @@ def log_action(
     details: dict = None,
     request: Request = None
 ):
-    """Log an action to the audit trail."""
+    """
+    Log an action to the audit trail.
+    
+    The entry is only added to the session; the caller commits it in the
+    same transaction as the change being logged.
+    """
     audit = AuditLog(
         action=action,
         entity_type=entity_type,
         entity_id=str(entity_id),
-        details=json.dumps(details) if details else None,
+        details=orjson.dumps(details).decode() if details else None,
         ip_address=request.client.host if request else None
     )
     db.add(audit)
-    db.commit()
 
 
 # --- Dashboard Endpoints ---
+def count_where(condition):
+    """SQL expression counting rows that match `condition` (0 on empty tables)."""
+    return func.coalesce(func.sum(case((condition, 1), else_=0)), 0)
+
+
 @app.get("/api/stats", response_model=DashboardStats)
 def get_dashboard_stats(db: Session = Depends(get_db)):
     """Get dashboard statistics."""
-    total_alerts = db.query(Alert).count()
-    total_incidents = db.query(Incident).count()
-    
-    # Count incidents by status
-    new_incidents = db.query(Incident).filter(Incident.status == IncidentStatus.NEW).count()
-    investigating = db.query(Incident).filter(Incident.status == IncidentStatus.INVESTIGATING).count()
-    contained = db.query(Incident).filter(Incident.status == IncidentStatus.CONTAINED).count()
-    closed = db.query(Incident).filter(Incident.status == IncidentStatus.CLOSED).count()
-    
-    # Critical = incidents with priority_score >= 70
-    critical = db.query(Incident).filter(Incident.priority_score >= 70).count()
+    total_alerts = db.query(func.count(Alert.id)).scalar()
+    
+    # Count incidents by status in a single pass;
+    # critical = incidents with priority_score >= 70
+    (
+        total_incidents, new_incidents, investigating, contained, closed, critical
+    ) = db.query(
+        func.count(Incident.id),
+        count_where(Incident.status == IncidentStatus.NEW),
+        count_where(Incident.status == IncidentStatus.INVESTIGATING),
+        count_where(Incident.status == IncidentStatus.CONTAINED),
+        count_where(Incident.status == IncidentStatus.CLOSED),
+        count_where(Incident.priority_score >= 70),
+    ).one()
     
     return DashboardStats(
         total_alerts=total_alerts,
@@ -122,6 +157,13 @@ def get_alert(alert_id: int, db: Session = Depends(get_db)):
 
 
 # --- Incident Endpoints ---
+def incidents_with_alert_count(db: Session):
+    """Query (Incident, alert_count) rows, counting alerts in the same SELECT."""
+    return db.query(
+        Incident, func.count(incident_alerts.c.alert_id).label("alert_count")
+    ).outerjoin(incident_alerts).group_by(Incident.id)
+
+
 @app.get("/api/incidents", response_model=List[IncidentListResponse])
 def get_incidents(
     skip: int = 0,
@@ -131,14 +173,14 @@ def get_incidents(
     db: Session = Depends(get_db)
 ):
     """Get all incidents with optional filtering."""
-    query = db.query(Incident)
+    query = incidents_with_alert_count(db)
     
     if status:
         query = query.filter(Incident.status == status)
     if min_priority is not None:
         query = query.filter(Incident.priority_score >= min_priority)
     
-    incidents = query.order_by(Incident.priority_score.desc()).offset(skip).limit(limit).all()
+    rows = query.order_by(Incident.priority_score.desc()).offset(skip).limit(limit).all()
     
     return [
         IncidentListResponse(
@@ -146,18 +188,18 @@ def get_incidents(
             title=inc.title,
             status=inc.status,
             priority_score=inc.priority_score,
-            alert_count=len(inc.alerts),
+            alert_count=alert_count,
             created_at=inc.created_at,
             updated_at=inc.updated_at
         )
-        for inc in incidents
+        for inc, alert_count in rows
     ]
 
 
 @app.get("/api/incidents/high-priority", response_model=List[IncidentListResponse])
 def get_high_priority_incidents(limit: int = 10, db: Session = Depends(get_db)):
     """Get top high-priority incidents for the dashboard queue."""
-    incidents = db.query(Incident).filter(
+    rows = incidents_with_alert_count(db).filter(
         Incident.status.in_([IncidentStatus.NEW, IncidentStatus.INVESTIGATING])
     ).order_by(Incident.priority_score.desc()).limit(limit).all()
     
@@ -167,18 +209,20 @@ def get_high_priority_incidents(limit: int = 10, db: Session = Depends(get_db)):
             title=inc.title,
             status=inc.status,
             priority_score=inc.priority_score,
-            alert_count=len(inc.alerts),
+            alert_count=alert_count,
             created_at=inc.created_at,
             updated_at=inc.updated_at
         )
-        for inc in incidents
+        for inc, alert_count in rows
     ]
 
 
 @app.get("/api/incidents/{incident_id}", response_model=IncidentResponse)
 def get_incident(incident_id: int, db: Session = Depends(get_db)):
     """Get detailed incident information including all alerts."""
-    incident = db.query(Incident).filter(Incident.id == incident_id).first()
+    incident = db.query(Incident).options(
+        selectinload(Incident.alerts)
+    ).filter(Incident.id == incident_id).first()
     if not incident:
         raise HTTPException(status_code=404, detail="Incident not found")
     return incident
@@ -208,16 +252,61 @@ def update_incident(
         changes["evidence"] = "updated"
     
     incident.updated_at = datetime.utcnow()
-    db.commit()
-    db.refresh(incident)
     
     # Audit log
     log_action(db, "status_change", "incident", incident_id, changes, request)
     
+    db.commit()
+    db.refresh(incident)
+    
     return incident
 
 
 # --- Data Ingestion Endpoints ---
+def insert_new_alerts(db: Session, normalized_alerts: List[NormalizedAlert]) -> Tuple[List[Alert], int]:
+    """
+    Bulk insert alerts whose alert_id is not stored yet.
+    
+    Returns the inserted Alert rows (with IDs) and the number of duplicates skipped.
+    """
+    incoming_ids = list({alert_data.alert_id for alert_data in normalized_alerts})
+    seen = set()
+    for batch in batched(incoming_ids):
+        seen.update(row[0] for row in db.query(Alert.alert_id).filter(Alert.alert_id.in_(batch)))
+    
+    to_insert = []
+    for alert_data in normalized_alerts:
+        # Skip alerts already stored or repeated within the file
+        if alert_data.alert_id in seen:
+            continue
+        seen.add(alert_data.alert_id)
+        to_insert.append(alert_data.to_mapping())
+    
+    skipped = len(normalized_alerts) - len(to_insert)
+    if not to_insert:
+        return [], skipped
+    
+    # INSERT ... RETURNING hands back the stored rows (with IDs) in input order
+    stmt = insert(Alert).returning(Alert, sort_by_parameter_order=True)
+    new_alerts = db.scalars(stmt, to_insert).all()
+    
+    return new_alerts, skipped
+
+
+def ingest_alerts(db: Session, normalized_alerts: List[NormalizedAlert]) -> Tuple[List[Alert], int, List[Incident]]:
+    """
+    Store new alerts and correlate them into incidents. Changes are flushed
+    but not committed, so the caller can commit them with its audit entry.
+    
+    Returns the inserted alerts, the number of duplicates skipped and the
+    created/updated incidents.
+    """
+    new_alerts, skipped = insert_new_alerts(db, normalized_alerts)
+    incidents = correlate_alerts(db, new_alerts)
+    db.flush()
+    return new_alerts, skipped, incidents
+
+
 @app.post("/api/upload", response_model=UploadResponse)
 async def upload_alerts(
     file: UploadFile = File(...),
@@ -229,51 +318,40 @@ async def upload_alerts(
     if not file.filename.endswith(('.json', '.csv')):
         raise HTTPException(status_code=400, detail="Only JSON and CSV files are supported")
     
-    # Read and parse file
-    content = await file.read()
+    # Parse straight from the spooled upload instead of copying its bytes into memory.
+    # Parsing and the database work below are blocking; run them in the
+    # threadpool so large uploads don't stall other requests
+    stream = None
     try:
-        content_str = content.decode('utf-8')
+        raw = file.file
+        if sys.version_info < (3, 11):
+            # SpooledTemporaryFile lacks readable()/readinto() before 3.11,
+            # so wrap the underlying BytesIO or temporary file instead
+            raw = getattr(raw, '_file', raw)
+        stream = io.TextIOWrapper(raw, encoding='utf-8', newline='')
+        normalized_alerts = await run_in_threadpool(parse_file, stream, file.filename)
     except UnicodeDecodeError:
         raise HTTPException(status_code=400, detail="Invalid file encoding. Use UTF-8.")
-    
-    try:
-        normalized_alerts = parse_file_content(content_str, file.filename)
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Failed to parse file: {str(e)}")
+    finally:
+        # Leave closing the underlying file to the UploadFile
+        if stream is not None:
+            stream.detach()
     
     if not normalized_alerts:
         raise HTTPException(status_code=400, detail="No valid alerts found in file")
     
-    # Create alert records
-    new_alerts = []
-    skipped = 0
-    for alert_data in normalized_alerts:
-        # Check for duplicate alert_id
-        existing = db.query(Alert).filter(Alert.alert_id == alert_data["alert_id"]).first()
-        if existing:
-            skipped += 1
-            continue
-        
-        alert = Alert(**alert_data)
-        db.add(alert)
-        new_alerts.append(alert)
-    
-    db.commit()
-    
-    # Refresh to get IDs
-    for alert in new_alerts:
-        db.refresh(alert)
+    # Create alert records and run correlation
+    new_alerts, skipped, incidents = await run_in_threadpool(ingest_alerts, db, normalized_alerts)
     
-    # Run correlation
-    incidents = correlate_alerts(db, new_alerts)
-    db.commit()
-    
-    # Audit log
+    # Audit log, committed together with the import
     log_action(db, "data_import", "alert", file.filename, {
         "alerts_imported": len(new_alerts),
         "skipped": skipped,
         "incidents_created": len(incidents)
     }, request)
+    await run_in_threadpool(db.commit)
     
     return UploadResponse(
         success=True,
@@ -284,6 +362,12 @@ async def upload_alerts(
     )
 
 
+def parse_demo_file(filepath: str) -> List[NormalizedAlert]:
+    """Read and normalize one demo data file."""
+    with open(filepath, 'r', newline='') as f:
+        return parse_file(f, os.path.basename(filepath))
+
+
 @app.post("/api/seed", response_model=UploadResponse)
 def seed_demo_data(request: Request, db: Session = Depends(get_db)):
     """Load demo dataset for testing."""
@@ -293,44 +377,25 @@ def seed_demo_data(request: Request, db: Session = Depends(get_db)):
     if not os.path.exists(demo_dir):
         raise HTTPException(status_code=404, detail="Demo data directory not found")
     
-    total_alerts = 0
-    total_incidents = 0
-    
-    # Process all JSON and CSV files in demo-data
-    for filename in os.listdir(demo_dir):
-        if filename.endswith(('.json', '.csv')):
-            filepath = os.path.join(demo_dir, filename)
-            with open(filepath, 'r') as f:
-                content = f.read()
-            
-            normalized_alerts = parse_file_content(content, filename)
-            
-            new_alerts = []
-            for alert_data in normalized_alerts:
-                existing = db.query(Alert).filter(Alert.alert_id == alert_data["alert_id"]).first()
-                if existing:
-                    continue
-                
-                alert = Alert(**alert_data)
-                db.add(alert)
-                new_alerts.append(alert)
-            
-            db.commit()
-            
-            for alert in new_alerts:
-                db.refresh(alert)
-            
-            incidents = correlate_alerts(db, new_alerts)
-            db.commit()
-            
-            total_alerts += len(new_alerts)
-            total_incidents += len(incidents)
+    # Parse all JSON and CSV files in demo-data concurrently
+    filenames = sorted(f for f in os.listdir(demo_dir) if f.endswith(('.json', '.csv')))
+    with ThreadPoolExecutor() as executor:
+        parsed = list(executor.map(
+            lambda filename: parse_demo_file(os.path.join(demo_dir, filename)), filenames
+        ))
+    normalized_alerts = [alert_data for file_alerts in parsed for alert_data in file_alerts]
+    
+    # One bulk insert and one correlation pass across all files
+    new_alerts, _, incidents = ingest_alerts(db, normalized_alerts)
+    total_alerts = len(new_alerts)
+    total_incidents = len(incidents)
     
     # Audit log
     log_action(db, "data_import", "demo", "seed", {
         "alerts_imported": total_alerts,
         "incidents_created": total_incidents
     }, request)
+    db.commit()
     
     return UploadResponse(
         success=True,
@@ -344,13 +409,13 @@ def seed_demo_data(request: Request, db: Session = Depends(get_db)):
 def recorrelate_alerts(request: Request, db: Session = Depends(get_db)):
     """Re-run correlation on all existing alerts."""
     incidents = recorrelate_all(db)
-    db.commit()
     
     total_alerts = db.query(Alert).count()
     
     log_action(db, "recorrelate", "system", "all", {
         "incidents_created": len(incidents)
     }, request)
+    db.commit()
     
     return UploadResponse(
         success=True,
@@ -364,19 +429,21 @@ def recorrelate_alerts(request: Request, db: Session = Depends(get_db)):
 @app.get("/api/incidents/{incident_id}/report", response_class=PlainTextResponse)
 def generate_incident_report(incident_id: int, request: Request, db: Session = Depends(get_db)):
     """Generate incident report as Markdown."""
-    incident = db.query(Incident).filter(Incident.id == incident_id).first()
+    incident = db.query(Incident).options(
+        selectinload(Incident.alerts)
+    ).filter(Incident.id == incident_id).first()
     if not incident:
         raise HTTPException(status_code=404, detail="Incident not found")
     
-    # Parse JSON fields
-    users = json.loads(incident.related_users) if incident.related_users else []
-    ips = json.loads(incident.related_ips) if incident.related_ips else []
-    devices = json.loads(incident.related_devices) if incident.related_devices else []
-    locations = json.loads(incident.related_locations) if incident.related_locations else []
-    score_explanation = json.loads(incident.score_explanation) if incident.score_explanation else {}
+    users = incident.related_users_list
+    ips = incident.related_ips_list
+    devices = incident.related_devices_list
+    locations = incident.related_locations_list
+    score_explanation = incident.score_explanation_dict
+    alerts = sorted(incident.alerts, key=lambda a: a.timestamp or datetime.min)
     
     # Build report
-    report = f"""# Incident Report: {incident.title}
+    parts = [f"""# Incident Report: {incident.title}
 
 ## Summary
 - **Incident ID**: {incident.id}
@@ -384,75 +451,53 @@ def generate_incident_report(incident_id: int, request: Request, db: Session = D
 - **Priority Score**: {incident.priority_score:.1f}/100
 - **Created**: {incident.created_at.strftime('%Y-%m-%d %H:%M:%S UTC')}
 - **Last Updated**: {incident.updated_at.strftime('%Y-%m-%d %H:%M:%S UTC')}
-- **Total Alerts**: {len(incident.alerts)}
+- **Total Alerts**: {len(alerts)}
 
 ## Priority Score Breakdown
 - **Severity Score**: {score_explanation.get('severity_score', 0)} - {score_explanation.get('severity_reason', 'N/A')}
 - **Entity Frequency Score**: {score_explanation.get('entity_frequency_score', 0)} - {score_explanation.get('entity_reason', 'N/A')}
 - **Risk Indicator Score**: {score_explanation.get('risk_indicator_score', 0)}
-"""
-    
-    risk_reasons = score_explanation.get('risk_reasons', [])
-    if risk_reasons:
-        for reason in risk_reasons:
-            report += f"  - {reason}\n"
-    
-    report += f"""
-## Related Entities
-### Users ({len(users)})
-"""
-    for user in users:
-        report += f"- {user}\n"
-    
-    report += f"""
-### IP Addresses ({len(ips)})
-"""
-    for ip in ips:
-        report += f"- {ip}\n"
-    
-    report += f"""
-### Devices ({len(devices)})
-"""
-    for device in devices:
-        report += f"- {device}\n"
-    
-    report += f"""
-### Locations ({len(locations)})
-"""
-    for loc in locations:
-        report += f"- {loc}\n"
-    
-    report += """
-## Alert Timeline
-"""
-    for alert in sorted(incident.alerts, key=lambda a: a.timestamp or datetime.min):
+"""]
+    
+    for reason in score_explanation.get('risk_reasons', []):
+        parts.append(f"  - {reason}\n")
+    
+    parts.append("\n## Related Entities\n")
+    for heading, values in (
+        ("Users", users),
+        ("IP Addresses", ips),
+        ("Devices", devices),
+        ("Locations", locations),
+    ):
+        if heading != "Users":
+            parts.append("\n")
+        parts.append(f"### {heading} ({len(values)})\n")
+        parts.extend(f"- {value}\n" for value in values)
+    
+    parts.append("\n## Alert Timeline\n")
+    for alert in alerts:
         ts = alert.timestamp.strftime('%Y-%m-%d %H:%M:%S') if alert.timestamp else 'Unknown'
-        report += f"### {ts} - {alert.title}\n"
-        report += f"- **Source**: {alert.source}\n"
-        report += f"- **Category**: {alert.category}\n"
-        report += f"- **Severity**: {alert.severity.value.title()}\n"
-        if alert.description:
-            report += f"- **Description**: {alert.description}\n"
-        report += "\n"
+        description = f"- **Description**: {alert.description}\n" if alert.description else ""
+        parts.append(
+            f"### {ts} - {alert.title}\n"
+            f"- **Source**: {alert.source}\n"
+            f"- **Category**: {alert.category}\n"
+            f"- **Severity**: {alert.severity.value.title()}\n"
+            f"{description}\n"
+        )
     
     if incident.notes:
-        report += f"""## Analyst Notes
-{incident.notes}
-"""
+        parts.append(f"## Analyst Notes\n{incident.notes}\n")
     
     if incident.evidence:
-        report += f"""
-## Evidence
-{incident.evidence}
-"""
+        parts.append(f"\n## Evidence\n{incident.evidence}\n")
     
-    report += f"""
----
-*Report generated on {datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S UTC')}*
-"""
+    parts.append(f"\n---\n*Report generated on {datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S UTC')}*\n")
+    report = "".join(parts)
     
     # Audit log
     log_action(db, "report_export", "incident", incident_id, {"format": "markdown"}, request)
+    db.commit()
     
     return report
 
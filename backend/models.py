@@ -1,6 +1,8 @@
 """SQLAlchemy ORM models for alerts, incidents, and audit logging."""
 from datetime import datetime
-from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, Table, Float, Enum as SQLEnum
+from typing import Any, Dict, List, Optional
+import orjson
+from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, Table, Float, Index, bindparam, case, select, text, update, Enum as SQLEnum
 from sqlalchemy.orm import relationship
 import enum
 from database import Base
@@ -13,6 +15,36 @@ class Severity(str, enum.Enum):
     CRITICAL = "critical"
 
 
+# Numeric rank per severity, stored on alerts so comparisons are plain ints
+SEVERITY_RANKS = {
+    Severity.LOW: 1,
+    Severity.MEDIUM: 2,
+    Severity.HIGH: 3,
+    Severity.CRITICAL: 4,
+}
+
+
+def severity_rank_default(context) -> int:
+    """Populate Alert.severity_rank from the severity being inserted."""
+    severity = context.get_current_parameters().get("severity") or Severity.MEDIUM
+    return SEVERITY_RANKS.get(severity, 0)
+
+
+def normalize_entity(value: Optional[str]) -> Optional[str]:
+    """
+    Case-fold a user or device name for matching. Done in Python rather
+    than SQL because SQLite's lower() only folds ASCII letters.
+    """
+    return value.lower() if value else None
+
+
+def entity_key_default(column: str):
+    """Column default populating a *_key column from the entity being inserted."""
+    def default(context) -> Optional[str]:
+        return normalize_entity(context.get_current_parameters().get(column))
+    return default
+
+
 class IncidentStatus(str, enum.Enum):
     NEW = "new"
     INVESTIGATING = "investigating"
@@ -38,14 +70,18 @@ class Alert(Base):
     source = Column(String(100))  # e.g., "Microsoft Defender", "Azure AD", "M365"
     category = Column(String(100))  # e.g., "Malware", "Phishing", "Suspicious Sign-in"
     severity = Column(SQLEnum(Severity), default=Severity.MEDIUM)
+    severity_rank = Column(Integer, default=severity_rank_default, index=True)  # From SEVERITY_RANKS
     title = Column(String(500))
     description = Column(Text)
     
     # Entity fields for correlation
-    entity_user = Column(String(255), index=True)
-    entity_ip = Column(String(45), index=True)  # Supports IPv6
-    entity_device = Column(String(255), index=True)
+    entity_user = Column(String(255))
+    entity_ip = Column(String(45))  # Supports IPv6
+    entity_device = Column(String(255))
     entity_location = Column(String(255))
+    # normalize_entity() of entity_user/entity_device, for case-insensitive lookups
+    entity_user_key = Column(String(255), default=entity_key_default("entity_user"))
+    entity_device_key = Column(String(255), default=entity_key_default("entity_device"))
     
     timestamp = Column(DateTime, default=datetime.utcnow, index=True)
     raw_data = Column(Text)  # Original JSON for reference
@@ -53,6 +89,56 @@ class Alert(Base):
 
     incidents = relationship("Incident", secondary=incident_alerts, back_populates="alerts")
 
+    # Composite indexes matching the correlation lookup (entity + time range).
+    # Users and devices are matched case-insensitively, so index their keys.
+    # Entity indexes cover the triage frequency counts (COUNT(id) ... GROUP BY
+    # entity); SQLite indexes carry the rowid (id) already, Postgres needs INCLUDE.
+    __table_args__ = (
+        Index("ix_alert_user_key_ts", entity_user_key, timestamp),
+        Index("ix_alert_ip_ts", entity_ip, timestamp),
+        Index("ix_alert_device_key_ts", entity_device_key, timestamp),
+        Index("ix_alerts_entity_user", entity_user, postgresql_include=["id"]),
+        Index("ix_alerts_entity_ip", entity_ip, postgresql_include=["id", "entity_user"]),
+        Index("ix_alerts_entity_device", entity_device, postgresql_include=["id"]),
+    )
+
+
+def backfill_severity_rank(bind) -> None:
+    """Fill Alert.severity_rank for rows stored before the column existed."""
+    with bind.begin() as connection:
+        connection.execute(
+            update(Alert.__table__)
+            .where(Alert.severity_rank.is_(None))
+            .values(severity_rank=case(
+                *((Alert.severity == severity, rank) for severity, rank in SEVERITY_RANKS.items()),
+                else_=SEVERITY_RANKS[Severity.MEDIUM],
+            ))
+        )
+
+
+# Indexes on lower(entity) used before the *_key columns existed
+OBSOLETE_ALERT_INDEXES = ("ix_alert_user_ts", "ix_alert_device_ts")
+
+
+def backfill_entity_keys(bind) -> None:
+    """Fill Alert.entity_*_key for rows stored before the columns existed."""
+    table = Alert.__table__
+    with bind.begin() as connection:
+        for index_name in OBSOLETE_ALERT_INDEXES:
+            connection.execute(text(f"DROP INDEX IF EXISTS {index_name}"))
+        for column, key_column in (
+            (table.c.entity_user, table.c.entity_user_key),
+            (table.c.entity_device, table.c.entity_device_key),
+        ):
+            rows = connection.execute(
+                select(table.c.id, column).where(column.isnot(None), key_column.is_(None))
+            ).all()
+            if rows:
+                connection.execute(
+                    update(table).where(table.c.id == bindparam("row_id")).values({key_column: bindparam("key")}),
+                    [{"row_id": row_id, "key": normalize_entity(value)} for row_id, value in rows],
+                )
+
 
 class Incident(Base):
     """Correlated group of related alerts forming a security incident."""
@@ -69,6 +155,8 @@ class Incident(Base):
     related_ips = Column(Text)  # JSON array
     related_devices = Column(Text)  # JSON array
     related_locations = Column(Text)  # JSON array
+    related_categories = Column(Text)  # JSON array, used for the title
+    max_severity = Column(SQLEnum(Severity))  # Highest alert severity, used for the title
     
     notes = Column(Text)
     evidence = Column(Text)  # Analyst-attached evidence (text)
@@ -78,6 +166,43 @@ class Incident(Base):
 
     alerts = relationship("Alert", secondary=incident_alerts, back_populates="incidents")
 
+    def parsed_json(self, column: str, default: Any) -> Any:
+        """
+        Parse a JSON column, memoized on this instance until the column's
+        value changes. The result is shared, so treat it as read-only.
+        """
+        raw = getattr(self, column)
+        cache = self.__dict__.setdefault("_parsed_json", {})
+        cached = cache.get(column)
+        if cached is None or cached[0] is not raw:
+            cached = (raw, orjson.loads(raw) if raw else default)
+            cache[column] = cached
+        return cached[1]
+
+    @property
+    def related_users_list(self) -> List[str]:
+        return self.parsed_json("related_users", [])
+
+    @property
+    def related_ips_list(self) -> List[str]:
+        return self.parsed_json("related_ips", [])
+
+    @property
+    def related_devices_list(self) -> List[str]:
+        return self.parsed_json("related_devices", [])
+
+    @property
+    def related_locations_list(self) -> List[str]:
+        return self.parsed_json("related_locations", [])
+
+    @property
+    def related_categories_list(self) -> List[str]:
+        return self.parsed_json("related_categories", [])
+
+    @property
+    def score_explanation_dict(self) -> Dict[str, Any]:
+        return self.parsed_json("score_explanation", {})
+
 
 class AuditLog(Base):
     """Audit trail for key system actions."""
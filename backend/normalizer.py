@@ -8,13 +8,45 @@ Supported formats:
 - Generic JSON/CSV with field mapping
 """
 import json
+import multiprocessing
+import orjson
 import csv
-import io
-from datetime import datetime
-from typing import List, Dict, Any, Optional
+import hashlib
+import re
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass, fields
+from datetime import datetime, timezone
+from itertools import islice
+from typing import List, Dict, Any, Iterable, Optional, TextIO, Tuple
 from models import Severity
 
 
+@dataclass(slots=True)
+class NormalizedAlert:
+    """An alert in the unified schema, ready to be stored as an Alert row."""
+    alert_id: str
+    source: str
+    category: str
+    severity: Severity
+    title: str
+    description: Optional[str]
+    entity_user: Optional[str]
+    entity_ip: Optional[str]
+    entity_device: Optional[str]
+    entity_location: Optional[str]
+    timestamp: datetime
+    raw_data: str
+    
+    def to_mapping(self) -> Dict[str, Any]:
+        """Column values for inserting the alert."""
+        return {name: getattr(self, name) for name in NORMALIZED_ALERT_FIELDS}
+
+
+NORMALIZED_ALERT_FIELDS = tuple(f.name for f in fields(NormalizedAlert))
+
+
 # Severity mapping from various source formats
 SEVERITY_MAPPINGS = {
     # Microsoft Defender
@@ -37,6 +69,26 @@ SEVERITY_MAPPINGS = {
 }
 
 
+# SEVERITY_MAPPINGS plus the usual capitalizations of each key
+SEVERITY_LOOKUP = {
+    variant: severity
+    for key, severity in SEVERITY_MAPPINGS.items()
+    for variant in (key, key.capitalize(), key.upper())
+}
+
+
+# Fields that identify the source format of an alert
+DEFENDER_KEYS = frozenset(("alertId", "detectionSource"))
+AZURE_AD_KEYS = frozenset(("riskEventType", "riskLevel"))
+
+# Records normalized per chunk (the unit of work for the process pool)
+NORMALIZE_CHUNK_SIZE = 1000
+
+# Files with more records than this are normalized across a process pool,
+# below it the pool startup cost outweighs the gain
+PARALLEL_NORMALIZE_THRESHOLD = 5000
+
+
 # Field mappings for different alert sources
 FIELD_MAPPINGS = {
     "defender": {
@@ -78,9 +130,18 @@ FIELD_MAPPINGS = {
 }
 
 
-def get_nested_value(obj: Dict, key_path: str) -> Optional[Any]:
-    """Get value from nested dict using dot notation (e.g., 'location.city')."""
-    keys = key_path.split(".")
+# Pre-split dotted paths once so lookups don't re-split them per alert
+FIELD_MAPPINGS = {
+    source_type: {
+        field: tuple(tuple(path.split(".")) for path in paths)
+        for field, paths in mapping.items()
+    }
+    for source_type, mapping in FIELD_MAPPINGS.items()
+}
+
+
+def get_nested_value(obj: Dict, keys: Tuple[str, ...]) -> Optional[Any]:
+    """Get value from nested dict by pre-split path (e.g., ('location', 'city'))."""
     value = obj
     for key in keys:
         if isinstance(value, dict) and key in value:
@@ -90,13 +151,53 @@ def get_nested_value(obj: Dict, key_path: str) -> Optional[Any]:
     return value
 
 
-def find_field_value(alert_data: Dict, field_options: List[str]) -> Optional[str]:
-    """Try multiple field names to find a value in the alert data."""
-    for field in field_options:
-        value = get_nested_value(alert_data, field)
-        if value is not None:
-            return str(value) if value else None
-    return None
+def build_field_index(mapping: Dict[str, Tuple[Tuple[str, ...], ...]]):
+    """
+    Build the reverse index for one source's field mapping.
+    
+    Returns (alias -> ((field, priority), ...), ((field, priority, path), ...))
+    where the second part holds the nested paths, which can't be matched
+    against top-level keys. Lower priority means earlier in the alias list.
+    """
+    aliases: Dict[str, List[Tuple[str, int]]] = {}
+    nested = []
+    for field, paths in mapping.items():
+        for priority, keys in enumerate(paths):
+            if len(keys) == 1:
+                aliases.setdefault(keys[0], []).append((field, priority))
+            else:
+                nested.append((field, priority, keys))
+    return {alias: tuple(targets) for alias, targets in aliases.items()}, tuple(nested)
+
+
+FIELD_INDEXES = {source_type: build_field_index(mapping) for source_type, mapping in FIELD_MAPPINGS.items()}
+
+
+def extract_fields(alert_data: Dict, field_index) -> Dict[str, Optional[str]]:
+    """
+    Resolve all mapped fields in one pass over the alert's keys.
+    
+    For each field, the first alias in mapping order with a non-None value
+    wins, and empty values resolve to None.
+    """
+    aliases, nested = field_index
+    found: Dict[str, Tuple[int, Any]] = {}
+    for key, value in alert_data.items():
+        if value is None:
+            continue
+        for field, priority in aliases.get(key, ()):
+            current = found.get(field)
+            if current is None or priority < current[0]:
+                found[field] = (priority, value)
+    
+    for field, priority, keys in nested:
+        current = found.get(field)
+        if current is None or priority < current[0]:
+            value = get_nested_value(alert_data, keys)
+            if value is not None:
+                found[field] = (priority, value)
+    
+    return {field: str(value) if value else None for field, (_, value) in found.items()}
 
 
 def normalize_severity(severity_value: Optional[str]) -> Severity:
@@ -104,126 +205,248 @@ def normalize_severity(severity_value: Optional[str]) -> Severity:
     if not severity_value:
         return Severity.MEDIUM
     
+    # Exact spellings hit the lookup table without allocating a new string
+    severity = SEVERITY_LOOKUP.get(severity_value)
+    if severity is not None:
+        return severity
+    
     normalized = severity_value.lower().strip()
     return SEVERITY_MAPPINGS.get(normalized, Severity.MEDIUM)
 
 
+# Fallback patterns for timestamps datetime.fromisoformat() rejects
+ISO_TIMESTAMP_PATTERN = re.compile(
+    r"^(\d{4})-(\d{1,2})-(\d{1,2})(?:[T ](\d{1,2}):(\d{1,2}):(\d{1,2})(?:\.(\d{1,6}))?)?Z?$"
+)
+US_TIMESTAMP_PATTERN = re.compile(
+    r"^(\d{1,2})/(\d{1,2})/(\d{4})(?: (\d{1,2}):(\d{1,2}):(\d{1,2}))?$"
+)
+
+
 def parse_timestamp(timestamp_value: Optional[str]) -> datetime:
-    """Parse various timestamp formats to datetime."""
+    """Parse various timestamp formats to a naive UTC datetime."""
     if not timestamp_value:
         return datetime.utcnow()
     
-    # Common ISO formats
-    formats = [
-        "%Y-%m-%dT%H:%M:%S.%fZ",
-        "%Y-%m-%dT%H:%M:%SZ",
-        "%Y-%m-%dT%H:%M:%S",
-        "%Y-%m-%d %H:%M:%S",
-        "%Y-%m-%d",
-        "%m/%d/%Y %H:%M:%S",
-        "%m/%d/%Y",
-    ]
-    
-    for fmt in formats:
+    value = timestamp_value.strip()
+    
+    # US format (MM/DD/YYYY [HH:MM:SS])
+    if "/" in value:
+        match = US_TIMESTAMP_PATTERN.match(value)
+        if match:
+            month, day, year, hour, minute, second = match.groups()
+            try:
+                return datetime(int(year), int(month), int(day),
+                                int(hour or 0), int(minute or 0), int(second or 0))
+            except ValueError:
+                pass
+        return datetime.utcnow()
+    
+    # ISO formats: fromisoformat() handles the common cases directly
+    try:
+        parsed = datetime.fromisoformat(value[:-1] if value.endswith("Z") else value)
+    except ValueError:
+        parsed = None
+    if parsed is not None:
+        if parsed.tzinfo is not None:
+            parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+        return parsed
+    
+    # Unpadded components or odd fraction lengths
+    match = ISO_TIMESTAMP_PATTERN.match(value)
+    if match:
+        year, month, day, hour, minute, second, fraction = match.groups()
         try:
-            return datetime.strptime(timestamp_value, fmt)
+            return datetime(int(year), int(month), int(day),
+                            int(hour or 0), int(minute or 0), int(second or 0),
+                            int(fraction.ljust(6, "0")) if fraction else 0)
         except ValueError:
-            continue
+            pass
     
     return datetime.utcnow()
 
 
 def detect_source(alert_data: Dict) -> str:
     """Detect the source format of an alert based on field presence."""
+    keys = alert_data.keys()
+    
     # Check for Microsoft Defender specific fields
-    if "alertId" in alert_data or "detectionSource" in alert_data:
+    if not keys.isdisjoint(DEFENDER_KEYS):
         return "defender"
     
     # Check for Azure AD specific fields
-    if "riskEventType" in alert_data or "riskLevel" in alert_data:
+    if not keys.isdisjoint(AZURE_AD_KEYS):
         return "azure_ad"
     
     # Check for source field
-    source = alert_data.get("source", "").lower()
-    if "defender" in source:
-        return "defender"
-    if "azure" in source or "aad" in source:
-        return "azure_ad"
+    source = alert_data.get("source")
+    if isinstance(source, str):
+        source = source.lower()
+        if "defender" in source:
+            return "defender"
+        if "azure" in source or "aad" in source:
+            return "azure_ad"
     
     return "generic"
 
 
-def normalize_alert(alert_data: Dict, source_hint: Optional[str] = None) -> Dict[str, Any]:
-    """
-    Normalize a single alert from any supported format to unified schema.
-    
-    Returns dict with: alert_id, source, category, severity, title, description,
-                       entity_user, entity_ip, entity_device, entity_location, timestamp
-    """
-    source_type = source_hint or detect_source(alert_data)
-    mapping = FIELD_MAPPINGS.get(source_type, FIELD_MAPPINGS["generic"])
+def fallback_alert_id(alert_data: Dict) -> str:
+    """Derive a stable ID for alerts without one by hashing their fields in key order."""
+    digest = hashlib.blake2b(digest_size=8)
+    for key in sorted(alert_data, key=str):
+        digest.update(str(key).encode())
+        digest.update(b"\x00")
+        digest.update(repr(alert_data[key]).encode())
+        digest.update(b"\x01")
+    return f"auto-{int.from_bytes(digest.digest(), 'big') % 10**8:08d}"
+
+
+def serialize_raw_alert(alert_data: Dict) -> str:
+    """Serialize the original alert once for raw_data."""
+    try:
+        return orjson.dumps(alert_data, default=str, option=orjson.OPT_NON_STR_KEYS).decode()
+    except TypeError:
+        # orjson rejects integers beyond 64 bits
+        return json.dumps(alert_data, default=str)
+
+
+def normalize_alert(alert_data: Dict) -> NormalizedAlert:
+    """Normalize a single alert from any supported format to unified schema."""
+    source_type = detect_source(alert_data)
+    values = extract_fields(alert_data, FIELD_INDEXES.get(source_type, FIELD_INDEXES["generic"]))
     
-    # Extract values using field mapping
-    alert_id = find_field_value(alert_data, mapping["alert_id"])
+    alert_id = values.get("alert_id")
     if not alert_id:
         # Generate ID if not found
-        alert_id = f"auto-{hash(json.dumps(alert_data, sort_keys=True, default=str)) % 10**8}"
+        alert_id = fallback_alert_id(alert_data)
     
-    title = find_field_value(alert_data, mapping["title"]) or "Unknown Alert"
-    description = find_field_value(alert_data, mapping["description"])
-    severity_raw = find_field_value(alert_data, mapping["severity"])
-    category = find_field_value(alert_data, mapping["category"]) or "Unknown"
-    timestamp_raw = find_field_value(alert_data, mapping["timestamp"])
+    title = values.get("title") or "Unknown Alert"
+    category = values.get("category") or "Unknown"
     
     # Determine source name
     source_name = alert_data.get("source", source_type.replace("_", " ").title())
     
-    return {
-        "alert_id": alert_id,
-        "source": source_name,
-        "category": category,
-        "severity": normalize_severity(severity_raw),
-        "title": title,
-        "description": description,
-        "entity_user": find_field_value(alert_data, mapping["entity_user"]),
-        "entity_ip": find_field_value(alert_data, mapping["entity_ip"]),
-        "entity_device": find_field_value(alert_data, mapping["entity_device"]),
-        "entity_location": find_field_value(alert_data, mapping["entity_location"]),
-        "timestamp": parse_timestamp(timestamp_raw),
-        "raw_data": json.dumps(alert_data, default=str),
-    }
+    return NormalizedAlert(
+        alert_id=alert_id,
+        source=source_name,
+        category=category,
+        severity=normalize_severity(values.get("severity")),
+        title=title,
+        description=values.get("description"),
+        entity_user=values.get("entity_user"),
+        entity_ip=values.get("entity_ip"),
+        entity_device=values.get("entity_device"),
+        entity_location=values.get("entity_location"),
+        timestamp=parse_timestamp(values.get("timestamp")),
+        raw_data=serialize_raw_alert(alert_data),
+    )
+
+
+def normalize_chunk(records: List[Dict]) -> List[NormalizedAlert]:
+    """Normalize one chunk of a file's records, detecting each record's source."""
+    return [normalize_alert(record) for record in records]
+
+
+_normalize_pool: Optional[ProcessPoolExecutor] = None
+_normalize_pool_lock = threading.Lock()
 
 
-def parse_json_file(content: str) -> List[Dict[str, Any]]:
-    """Parse JSON content (single alert or array of alerts)."""
-    data = json.loads(content)
+def get_normalize_pool() -> ProcessPoolExecutor:
+    """
+    Return the process pool for large files, created on first use and reused.
     
+    Uploads are parsed in server worker threads with an open database
+    engine, so workers are started via forkserver (spawn where unavailable)
+    rather than by forking this process.
+    """
+    global _normalize_pool
+    with _normalize_pool_lock:
+        if _normalize_pool is None:
+            method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            _normalize_pool = ProcessPoolExecutor(mp_context=multiprocessing.get_context(method))
+        return _normalize_pool
+
+
+def discard_normalize_pool(pool: ProcessPoolExecutor) -> None:
+    """Stop using a pool whose workers died, so the next call starts a fresh one."""
+    global _normalize_pool
+    with _normalize_pool_lock:
+        if _normalize_pool is pool:
+            _normalize_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def shutdown_normalize_pool() -> None:
+    """Shut down the process pool, if one was started (on app shutdown)."""
+    global _normalize_pool
+    with _normalize_pool_lock:
+        pool, _normalize_pool = _normalize_pool, None
+    if pool is not None:
+        pool.shutdown()
+
+
+def normalize_alerts(records: Iterable[Dict]) -> List[NormalizedAlert]:
+    """
+    Normalize the records of one file.
+    
+    Records are normalized in chunks of NORMALIZE_CHUNK_SIZE. Files with more
+    than PARALLEL_NORMALIZE_THRESHOLD records spread the chunks across a
+    process pool.
+    """
+    iterator = iter(records)
+    chunks = list(iter(lambda: list(islice(iterator, NORMALIZE_CHUNK_SIZE)), []))
+    
+    if len(chunks) * NORMALIZE_CHUNK_SIZE > PARALLEL_NORMALIZE_THRESHOLD:
+        pool = get_normalize_pool()
+        try:
+            results = list(pool.map(normalize_chunk, chunks))
+        except BrokenProcessPool:
+            discard_normalize_pool(pool)
+            raise
+    else:
+        results = [normalize_chunk(chunk) for chunk in chunks]
+    
+    return [alert for chunk in results for alert in chunk]
+
+
+def parse_json_stream(stream: TextIO) -> List[NormalizedAlert]:
+    """Parse JSON from an open text stream (read whole, then decoded)."""
+    return normalize_json_data(json.load(stream))
+
+
+def normalize_json_data(data: Any) -> List[NormalizedAlert]:
+    """Normalize decoded JSON (single alert or array of alerts)."""
     # Handle array of alerts
     if isinstance(data, list):
-        return [normalize_alert(alert) for alert in data]
+        return normalize_alerts(data)
     
     # Handle single alert
     if isinstance(data, dict):
         # Check if alerts are nested under a key
         if "value" in data:  # Microsoft Graph API format
-            return [normalize_alert(alert) for alert in data["value"]]
+            return normalize_alerts(data["value"])
         if "alerts" in data:
-            return [normalize_alert(alert) for alert in data["alerts"]]
+            return normalize_alerts(data["alerts"])
         # Single alert
         return [normalize_alert(data)]
     
     return []
 
 
-def parse_csv_file(content: str) -> List[Dict[str, Any]]:
-    """Parse CSV content to alerts."""
-    reader = csv.DictReader(io.StringIO(content))
-    return [normalize_alert(dict(row)) for row in reader]
+def parse_csv_stream(stream: TextIO) -> List[NormalizedAlert]:
+    """Parse CSV rows from an open text stream, one row at a time."""
+    return normalize_alerts(csv.DictReader(stream))
 
 
-def parse_file_content(content: str, filename: str) -> List[Dict[str, Any]]:
-    """Parse file content based on extension."""
+def parse_file(stream: TextIO, filename: str) -> List[NormalizedAlert]:
+    """
+    Parse an open text stream based on the file extension.
+    
+    CSV is parsed row by row without holding the file in memory. JSON is
+    read into one decoded string before parsing; only the extra copy of
+    the raw bytes is avoided.
+    """
     if filename.lower().endswith(".csv"):
-        return parse_csv_file(content)
+        return parse_csv_stream(stream)
     else:
-        return parse_json_file(content)
+        return parse_json_stream(stream)
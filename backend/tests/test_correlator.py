@@ -0,0 +1,114 @@
+"""Tests for alert correlation."""
+import os
+import random
+import sys
+import unittest
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from correlator import (
+    MIN_OVERLAP_SCORE, UnionFind, calculate_entity_overlap, is_within_time_window, recorrelate_all
+)
+from database import Base
+from models import Alert, Incident, IncidentStatus, Severity
+
+
+def random_alerts(seed: int, count: int = 120):
+    """Alerts with overlapping, case-varied entities, some without a timestamp."""
+    rng = random.Random(seed)
+    start = datetime(2024, 1, 15)
+    alerts = []
+    for i in range(count):
+        undated = rng.random() < 0.05
+        alerts.append(Alert(
+            alert_id=f"{seed}-{i}",
+            category=rng.choice(["Malware", "Phishing"]),
+            severity=rng.choice(list(Severity)),
+            title="Alert",
+            entity_user=rng.choice([None, "alice@contoso.com", "ALICE@contoso.com", "bob@contoso.com", "éric@contoso.com", "ÉRIC@contoso.com"]),
+            entity_ip=rng.choice([None, "10.0.0.1", "10.0.0.2", "10.0.0.3", "10.0.0.4"]),
+            entity_device=rng.choice([None, "PC-01", "pc-01", "LAPTOP-02"]),
+            timestamp=None if undated else start + timedelta(minutes=rng.randint(0, 12 * 60)),
+        ))
+    return alerts
+
+
+def expected_groups(alerts):
+    """Connected components of the pairwise correlation rule."""
+    uf = UnionFind()
+    for alert in alerts:
+        uf.add(alert.id)
+    for i, alert in enumerate(alerts):
+        for other in alerts[i + 1:]:
+            if is_within_time_window(alert, other) and calculate_entity_overlap(alert, other) >= MIN_OVERLAP_SCORE:
+                uf.union(alert.id, other.id)
+    groups = {}
+    for alert in alerts:
+        groups.setdefault(uf.find(alert.id), set()).add(alert.id)
+    return sorted(sorted(group) for group in groups.values())
+
+
+class RecorrelateAllTest(unittest.TestCase):
+    """recorrelate_all must match pairwise correlation and keep unchanged incidents."""
+
+    def new_session(self):
+        engine = create_engine("sqlite://")
+        Base.metadata.create_all(bind=engine)
+        db = sessionmaker(bind=engine, autoflush=False)()
+        self.addCleanup(db.close)
+        return db
+
+    def load(self, db, seed: int):
+        alerts = random_alerts(seed)
+        undated = [alert.alert_id for alert in alerts if alert.timestamp is None]
+        db.add_all(alerts)
+        db.flush()
+        # Inserting None picks up the utcnow default, so clear those afterwards
+        db.query(Alert).filter(Alert.alert_id.in_(undated)).update({Alert.timestamp: None}, synchronize_session=False)
+        db.commit()
+        return db.query(Alert).order_by(Alert.id).all()
+
+    def incident_state(self, db):
+        return {
+            incident.id: (sorted(alert.id for alert in incident.alerts), incident.status, incident.notes)
+            for incident in db.query(Incident)
+        }
+
+    def test_groups_match_pairwise_connected_components(self):
+        for seed in range(5):
+            with self.subTest(seed=seed):
+                db = self.new_session()
+                alerts = self.load(db, seed)
+                self.assertTrue(any(alert.timestamp is None for alert in alerts))
+
+                recorrelate_all(db)
+                db.commit()
+
+                groups = sorted(members for members, _, _ in self.incident_state(db).values())
+                self.assertEqual(groups, expected_groups(alerts))
+
+    def test_second_run_keeps_incident_ids_status_and_notes(self):
+        db = self.new_session()
+        self.load(db, seed=7)
+        recorrelate_all(db)
+        db.commit()
+
+        for incident in db.query(Incident):
+            incident.status = IncidentStatus.INVESTIGATING
+            incident.notes = f"note {incident.id}"
+        db.commit()
+        before = self.incident_state(db)
+
+        recorrelate_all(db)
+        db.commit()
+        db.expire_all()
+
+        self.assertEqual(self.incident_state(db), before)
+
+
+if __name__ == "__main__":
+    unittest.main()
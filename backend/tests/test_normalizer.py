@@ -0,0 +1,48 @@
+"""Tests for alert normalization."""
+import io
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from models import Severity
+from normalizer import parse_file
+
+
+MIXED_SOURCE_JSON = """[
+    {"id": "gen-1", "title": "Generic alert", "severity": "low",
+     "user": "bob@contoso.com", "ip": "10.0.0.1", "device": "PC-01",
+     "timestamp": "2024-01-15T03:00:00Z"},
+    {"alertId": "def-1", "title": "Defender alert", "severity": "high",
+     "userPrincipalName": "alice@contoso.com", "ipAddress": "10.0.0.2",
+     "deviceName": "LAPTOP-01", "createdDateTime": "2024-01-15T03:10:00Z"},
+    {"id": "aad-1", "riskEventType": "unfamiliarFeatures", "riskLevel": "high",
+     "userPrincipalName": "carol@contoso.com", "ipAddress": "10.0.0.3",
+     "deviceDetail": {"displayName": "TABLET-01"},
+     "activityDateTime": "2024-01-15T03:20:00Z"}
+]"""
+
+
+class MixedSourceFileTest(unittest.TestCase):
+    """A file mixing sources must map each record with its own source's fields."""
+    
+    def test_each_record_uses_its_own_source_mapping(self):
+        alerts = parse_file(io.StringIO(MIXED_SOURCE_JSON), "mixed.json")
+        
+        self.assertEqual(
+            [(a.alert_id, a.title, a.severity, a.entity_user, a.entity_ip, a.entity_device) for a in alerts],
+            [
+                ("gen-1", "Generic alert", Severity.LOW, "bob@contoso.com", "10.0.0.1", "PC-01"),
+                ("def-1", "Defender alert", Severity.HIGH, "alice@contoso.com", "10.0.0.2", "LAPTOP-01"),
+                ("aad-1", "unfamiliarFeatures", Severity.HIGH, "carol@contoso.com", "10.0.0.3", "TABLET-01"),
+            ],
+        )
+        self.assertEqual(
+            [a.timestamp.isoformat() for a in alerts],
+            ["2024-01-15T03:00:00", "2024-01-15T03:10:00", "2024-01-15T03:20:00"],
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
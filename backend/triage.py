@@ -6,9 +6,13 @@ Score components:
 2. Entity frequency (how often entities appear in other alerts)
 3. Risk indicators (suspicious patterns)
 """
-from typing import List, Dict, Set, Tuple, Any
+import re
+from dataclasses import dataclass
+from typing import List, Dict, Iterable, Set, Tuple, Any
+from sqlalchemy import func
 from sqlalchemy.orm import Session
-from models import Alert, Severity
+from database import batched
+from models import Alert, Severity, SEVERITY_RANKS
 
 
 # Severity base scores
@@ -19,26 +23,86 @@ SEVERITY_SCORES = {
     Severity.LOW: 10,
 }
 
+# SEVERITY_SCORES indexed by Alert.severity_rank (0 = unknown)
+SEVERITY_SCORES_BY_RANK = tuple(
+    next((SEVERITY_SCORES[severity] for severity, r in SEVERITY_RANKS.items() if r == rank), 0)
+    for rank in range(max(SEVERITY_RANKS.values()) + 1)
+)
+CRITICAL_RANK = SEVERITY_RANKS[Severity.CRITICAL]
+HIGH_RANK = SEVERITY_RANKS[Severity.HIGH]
+
+# Caps for the entity frequency and risk indicator components; once reached,
+# the remaining database queries for that component are skipped
+ENTITY_FREQUENCY_SCORE_CAP = 30
+RISK_SCORE_CAP = 30
+
 # Entity frequency thresholds
 ENTITY_FREQUENCY_THRESHOLD = 3  # Number of alerts with same entity to trigger bonus
 
+# Categories that add a risk indicator bonus
+SUSPICIOUS_CATEGORIES = frozenset([
+    "malware", "ransomware", "phishing", "credential theft",
+    "lateral movement", "data exfiltration", "privilege escalation",
+])
+
+# Title keywords of failed/blocked actions, matched case-insensitively in a
+# single regex pass (no lowercased copy of each title)
+FAILED_KEYWORDS = ("failed", "blocked", "denied", "unauthorized")
+FAILED_KEYWORDS_PATTERN = re.compile("|".join(FAILED_KEYWORDS), re.IGNORECASE)
+
+# (alert column, bonus points, label for the explanation) for users, ips
+# and devices, in that order
+ENTITY_FREQUENCY_RULES = (
+    (Alert.entity_user, 10, "User"),
+    (Alert.entity_ip, 8, "IP"),
+    (Alert.entity_device, 5, "Device"),
+)
+
+
+@dataclass(slots=True, frozen=True)
+class IncidentEntities:
+    """Entity values of an incident, as read by the triage scoring."""
+    users: Tuple[str, ...]
+    ips: Tuple[str, ...]
+    devices: Tuple[str, ...]
+    locations: Tuple[str, ...]
+    
+    @classmethod
+    def from_sets(cls, entities: Dict[str, Set[str]]) -> "IncidentEntities":
+        """Build from the correlator's entity-type -> values sets."""
+        return cls(
+            tuple(entities["users"]),
+            tuple(entities["ips"]),
+            tuple(entities["devices"]),
+            tuple(entities["locations"]),
+        )
+
 
 def calculate_severity_score(alerts: List[Alert]) -> Tuple[float, str]:
     """Calculate score based on alert severities."""
     if not alerts:
         return 0, "No alerts"
     
-    # Get maximum severity
-    max_severity = max(alerts, key=lambda a: SEVERITY_SCORES.get(a.severity, 0))
-    score = SEVERITY_SCORES.get(max_severity.severity, 0)
+    # Get maximum severity and count high/critical alerts in one pass
+    score = -1
+    max_severity = None
+    critical_count = 0
+    high_count = 0
+    for alert in alerts:
+        rank = alert.severity_rank or 0
+        severity_score = SEVERITY_SCORES_BY_RANK[rank]
+        if severity_score > score:
+            score = severity_score
+            max_severity = alert.severity
+        if rank == CRITICAL_RANK:
+            critical_count += 1
+        elif rank == HIGH_RANK:
+            high_count += 1
     
     # Bonus for multiple high/critical alerts
-    critical_count = sum(1 for a in alerts if a.severity == Severity.CRITICAL)
-    high_count = sum(1 for a in alerts if a.severity == Severity.HIGH)
-    
     bonus = (critical_count * 5) + (high_count * 2)
     
-    reason = f"Highest severity: {max_severity.severity.value}"
+    reason = f"Highest severity: {max_severity.value}"
     if critical_count > 1:
         reason += f", {critical_count} critical alerts (+{critical_count * 5})"
     if high_count > 1:
@@ -47,47 +111,46 @@ def calculate_severity_score(alerts: List[Alert]) -> Tuple[float, str]:
     return score + bonus, reason
 
 
+def count_alerts_by(db: Session, column, values: Iterable[str]) -> Dict[str, int]:
+    """Count alerts per value of an entity column with batched GROUP BY queries."""
+    counts = {}
+    for batch in batched([value for value in values if value]):
+        counts.update(
+            db.query(column, func.count(Alert.id)).filter(column.in_(batch)).group_by(column)
+        )
+    return counts
+
+
 def calculate_entity_frequency_score(
     alerts: List[Alert],
-    entities: Dict[str, Set[str]],
+    entities: IncidentEntities,
     db: Session
 ) -> Tuple[float, str]:
     """Calculate score based on entity frequency across all alerts."""
     score = 0
     reasons = []
     
-    # Check each entity type
-    for entity_type, entity_values in entities.items():
+    # Check each entity type, skipping the remaining queries once capped
+    entity_values_by_type = (entities.users, entities.ips, entities.devices)
+    for entity_values, (column, points, label) in zip(entity_values_by_type, ENTITY_FREQUENCY_RULES):
+        if score >= ENTITY_FREQUENCY_SCORE_CAP:
+            break
+        
+        # Count occurrences in database, one grouped query per type
+        counts = count_alerts_by(db, column, entity_values)
         for entity_value in entity_values:
-            if not entity_value:
-                continue
-            
-            # Count occurrences in database
-            if entity_type == "users":
-                count = db.query(Alert).filter(Alert.entity_user == entity_value).count()
-                if count >= ENTITY_FREQUENCY_THRESHOLD:
-                    score += 10
-                    reasons.append(f"User '{entity_value}' in {count} alerts")
-            
-            elif entity_type == "ips":
-                count = db.query(Alert).filter(Alert.entity_ip == entity_value).count()
-                if count >= ENTITY_FREQUENCY_THRESHOLD:
-                    score += 8
-                    reasons.append(f"IP '{entity_value}' in {count} alerts")
-            
-            elif entity_type == "devices":
-                count = db.query(Alert).filter(Alert.entity_device == entity_value).count()
-                if count >= ENTITY_FREQUENCY_THRESHOLD:
-                    score += 5
-                    reasons.append(f"Device '{entity_value}' in {count} alerts")
+            count = counts.get(entity_value, 0)
+            if count >= ENTITY_FREQUENCY_THRESHOLD:
+                score += points
+                reasons.append(f"{label} '{entity_value}' in {count} alerts")
     
     reason = "; ".join(reasons) if reasons else "No frequent entities"
-    return min(score, 30), reason  # Cap at 30
+    return min(score, ENTITY_FREQUENCY_SCORE_CAP), reason
 
 
 def detect_risk_indicators(
     alerts: List[Alert],
-    entities: Dict[str, Set[str]],
+    entities: IncidentEntities,
     db: Session
 ) -> Tuple[float, List[str]]:
     """
@@ -103,67 +166,81 @@ def detect_risk_indicators(
     score = 0
     reasons = []
     
-    # Check for multiple users on same IP
-    for ip in entities.get("ips", []):
-        if not ip:
-            continue
-        users_on_ip = db.query(Alert.entity_user).filter(
-            Alert.entity_ip == ip,
-            Alert.entity_user.isnot(None)
-        ).distinct().all()
-        
-        if len(users_on_ip) > 2:
-            score += 15
-            reasons.append(f"IP {ip} used by {len(users_on_ip)} different users")
-    
-    # Check for suspicious categories
-    suspicious_categories = ["malware", "ransomware", "phishing", "credential theft", 
-                            "lateral movement", "data exfiltration", "privilege escalation"]
+    # Scan alerts once for the in-memory indicators
+    suspicious_category = None
+    failed_count = 0
+    off_hours_count = 0
+    first_seen = last_seen = None
     for alert in alerts:
-        if alert.category and alert.category.lower() in suspicious_categories:
-            score += 10
-            reasons.append(f"High-risk category: {alert.category}")
-            break  # Only count once
+        if suspicious_category is None and alert.category and alert.category.lower() in SUSPICIOUS_CATEGORIES:
+            suspicious_category = alert.category
+        if alert.title and FAILED_KEYWORDS_PATTERN.search(alert.title):
+            failed_count += 1
+        timestamp = alert.timestamp
+        if timestamp:
+            # Outside 6 AM - 8 PM
+            if timestamp.hour < 6 or timestamp.hour > 20:
+                off_hours_count += 1
+            if first_seen is None or timestamp < first_seen:
+                first_seen = timestamp
+            if last_seen is None or timestamp > last_seen:
+                last_seen = timestamp
+    
+    # Check for suspicious categories (only count once)
+    if suspicious_category is not None:
+        score += 10
+        reasons.append(f"High-risk category: {suspicious_category}")
     
     # Check for impossible travel (placeholder - would need geolocation in production)
-    locations = list(entities.get("locations", []))
-    if len(locations) > 1 and len(entities.get("users", [])) == 1:
+    locations = list(entities.locations)
+    if len(locations) > 1 and len(entities.users) == 1:
         # Same user, multiple locations
-        user = list(entities["users"])[0] if entities.get("users") else "Unknown"
+        user = entities.users[0]
         
         # Check time span
-        timestamps = [a.timestamp for a in alerts if a.timestamp]
-        if timestamps:
-            time_span = (max(timestamps) - min(timestamps)).total_seconds() / 3600
+        if first_seen is not None:
+            time_span = (last_seen - first_seen).total_seconds() / 3600
             if time_span < 2 and len(locations) > 1:
                 score += 20
                 reasons.append(f"Possible impossible travel: user {user} in {locations} within {time_span:.1f}h")
     
     # Check for multiple failed sign-ins
-    failed_keywords = ["failed", "blocked", "denied", "unauthorized"]
-    failed_count = sum(
-        1 for a in alerts 
-        if a.title and any(kw in a.title.lower() for kw in failed_keywords)
-    )
     if failed_count >= 3:
         score += 10
         reasons.append(f"{failed_count} failed/blocked actions detected")
     
-    # Check for off-hours activity (outside 6 AM - 8 PM)
-    off_hours_count = sum(
-        1 for a in alerts 
-        if a.timestamp and (a.timestamp.hour < 6 or a.timestamp.hour > 20)
-    )
+    # Check for off-hours activity
     if off_hours_count > len(alerts) / 2:
         score += 5
         reasons.append(f"{off_hours_count}/{len(alerts)} alerts during off-hours")
     
-    return min(score, 30), reasons  # Cap at 30
+    # Check for multiple users on same IP. This is the only indicator that
+    # queries the database, so it runs last and only if the cap isn't reached;
+    # its reasons still come first.
+    if score < RISK_SCORE_CAP:
+        ips = [ip for ip in entities.ips if ip]
+        users_per_ip = {}
+        for batch in batched(ips):
+            users_per_ip.update(
+                db.query(Alert.entity_ip, func.count(Alert.entity_user.distinct()))
+                .filter(Alert.entity_ip.in_(batch), Alert.entity_user.isnot(None))
+                .group_by(Alert.entity_ip)
+            )
+        
+        ip_reasons = []
+        for ip in ips:
+            user_count = users_per_ip.get(ip, 0)
+            if user_count > 2:
+                score += 15
+                ip_reasons.append(f"IP {ip} used by {user_count} different users")
+        reasons[:0] = ip_reasons
+    
+    return min(score, RISK_SCORE_CAP), reasons
 
 
 def calculate_triage_score(
     alerts: List[Alert],
-    entities: Dict[str, Set[str]],
+    entities: IncidentEntities,
     db: Session
 ) -> Tuple[float, Dict[str, Any]]:
     """